@@ -1,3 +1,4 @@
+import re
 from contextlib import contextmanager
 
 from stone import ir
@@ -7,21 +8,40 @@ from stone.backends.helpers import (
     fmt_underscores
 )
 
-RUST_RESERVED_WORDS = [
+RUST_RESERVED_WORDS = frozenset([
     "abstract", "alignof", "as", "async", "become", "box", "break", "const", "continue", "crate",
     "do", "else", "enum", "extern", "false", "final", "fn", "for", "if", "impl", "in", "let",
     "loop", "macro", "match", "mod", "move", "mut", "offsetof", "override", "priv", "proc", "pub",
     "pure", "ref", "return", "Self", "self", "sizeof", "static", "struct", "super", "trait",
     "true", "type", "typeof", "unsafe", "unsized", "use", "virtual", "where", "while", "yield",
-]
+])
 
 # Also avoid using names of types that are in the prelude for the names of our types.
-RUST_GLOBAL_NAMESPACE = [
+RUST_GLOBAL_NAMESPACE = frozenset([
     "Copy", "Send", "Sized", "Sync", "Drop", "Fn", "FnMut", "FnOnce", "drop", "Box", "ToOwned",
     "Clone", "PartialEq", "PartialOrd", "Eq", "Ord", "AsRef", "AsMut", "Into", "From", "Default",
     "Iterator", "Extend", "IntoIterator", "DoubleEndedIterator", "ExactSizeIterator", "Option",
     "Some", "None", "Result", "Ok", "Err", "SliceConcatExt", "String", "ToString", "Vec",
-]
+])
+
+# Names which can't be used for our types or modules.
+RUST_RESERVED_TYPE_NAMES = RUST_RESERVED_WORDS | RUST_GLOBAL_NAMESPACE
+
+# Names that are already lowercase words separated by single underscores (which is most of them in
+# the spec) need none of the general word-splitting done by stone's formatting helpers.
+_SIMPLE_NAME_RE = re.compile(r'^[a-z][a-z0-9]*(?:_[a-z0-9]+)*$')
+
+
+def _fmt_underscores(name):
+    if _SIMPLE_NAME_RE.match(name):
+        return name
+    return fmt_underscores(name)
+
+
+def _fmt_pascal(name):
+    if _SIMPLE_NAME_RE.match(name):
+        return ''.join([word.capitalize() for word in name.split('_')])
+    return fmt_pascal(name)
 
 
 class RustHelperBackend(CodeBackend):
@@ -29,6 +49,18 @@ class RustHelperBackend(CodeBackend):
     A superclass for RustGenerator and TestGenerator to contain some common rust-generation methods.
     """
 
+    def __init__(self, target_folder_path, args):
+        super(RustHelperBackend, self).__init__(target_folder_path, args)
+        # The naming rules are pure functions of the names in the spec, and get called over and
+        # over for the same names, so their results are memoized here, one dict per rule.
+        self._namespace_names = {}
+        self._struct_names = {}
+        self._enum_names = {}
+        self._field_names = {}
+        self._enum_variant_names = {}
+        self._route_names = {}
+        self._alias_names = {}
+
     def _dent_len(self):
         if self.tabs_for_indents:
             return 4 * self.cur_indent
@@ -50,8 +82,8 @@ class RustHelperBackend(CodeBackend):
             access = u''
         else:
             access += u' '
-        ret = u' -> {}'.format(return_type) if return_type is not None else u''
-        one_line = u'{}fn {}({}){} {{'.format(
+        ret = u' -> %s' % return_type if return_type is not None else u''
+        one_line = u'%sfn %s(%s)%s {' % (
             access,
             name,
             self._arg_list(args),
@@ -61,11 +93,11 @@ class RustHelperBackend(CodeBackend):
             self.emit(one_line)
         else:
             # one arg per line
-            self.emit(u'{}fn {}('.format(access, name))
+            self.emit(u'%sfn %s(' % (access, name))
             with self.indent():
                 for arg in args:
                     self.emit(arg + ',')
-            self.emit(u'){} {{'.format(ret))
+            self.emit(u')%s {' % ret)
 
         with self.indent():
             yield
@@ -78,7 +110,7 @@ class RustHelperBackend(CodeBackend):
         """
         if end is None:
             end = u''
-        one_line = u'{}({}){}'.format(
+        one_line = u'%s(%s)%s' % (
             func_name,
             self._arg_list(args),
             end)
@@ -94,58 +126,134 @@ class RustHelperBackend(CodeBackend):
         return isinstance(typ, ir.Union) or \
             (isinstance(typ, ir.Struct) and typ.has_enumerated_subtypes())
 
+    # Naming rules. The ones that take a spec object cache their result on that object, under a
+    # _rust_* attribute, because they get called many times for the same objects. The *_raw ones
+    # take plain names, and are memoized per name.
+
     def namespace_name(self, ns):
-        return self.namespace_name_raw(ns.name)
+        try:
+            return ns._rust_namespace_name
+        except AttributeError:
+            name = ns._rust_namespace_name = self.namespace_name_raw(ns.name)
+            return name
 
     def namespace_name_raw(self, ns_name):
-        name = fmt_underscores(ns_name)
-        if name in RUST_RESERVED_WORDS + RUST_GLOBAL_NAMESPACE:
+        try:
+            return self._namespace_names[ns_name]
+        except KeyError:
+            pass
+        name = _fmt_underscores(ns_name)
+        if name in RUST_RESERVED_TYPE_NAMES:
             name = 'dbx_' + name
+        self._namespace_names[ns_name] = name
         return name
 
     def struct_name(self, struct):
-        name = fmt_pascal(struct.name)
-        if name in RUST_RESERVED_WORDS + RUST_GLOBAL_NAMESPACE:
+        try:
+            return struct._rust_struct_name
+        except AttributeError:
+            name = struct._rust_struct_name = self.struct_name_raw(struct.name)
+            return name
+
+    def struct_name_raw(self, struct_name):
+        try:
+            return self._struct_names[struct_name]
+        except KeyError:
+            pass
+        name = _fmt_pascal(struct_name)
+        if name in RUST_RESERVED_TYPE_NAMES:
             name += 'Struct'
+        self._struct_names[struct_name] = name
         return name
 
     def enum_name(self, union):
-        name = fmt_pascal(union.name)
-        if name in RUST_RESERVED_WORDS + RUST_GLOBAL_NAMESPACE:
+        try:
+            return union._rust_enum_name
+        except AttributeError:
+            name = union._rust_enum_name = self.enum_name_raw(union.name)
+            return name
+
+    def enum_name_raw(self, union_name):
+        try:
+            return self._enum_names[union_name]
+        except KeyError:
+            pass
+        name = _fmt_pascal(union_name)
+        if name in RUST_RESERVED_TYPE_NAMES:
             name += 'Union'
+        self._enum_names[union_name] = name
         return name
 
     def field_name(self, field):
-        return self.field_name_raw(field.name)
+        try:
+            return field._rust_field_name
+        except AttributeError:
+            name = field._rust_field_name = self.field_name_raw(field.name)
+            return name
 
     def field_name_raw(self, name):
-        name = fmt_underscores(name)
-        if name in RUST_RESERVED_WORDS:
-            name += '_field'
-        return name
+        try:
+            return self._field_names[name]
+        except KeyError:
+            pass
+        rust_name = _fmt_underscores(name)
+        if rust_name in RUST_RESERVED_WORDS:
+            rust_name += '_field'
+        self._field_names[name] = rust_name
+        return rust_name
 
     def enum_variant_name(self, field):
-        return self.enum_variant_name_raw(field.name)
+        try:
+            return field._rust_variant_name
+        except AttributeError:
+            name = field._rust_variant_name = self.enum_variant_name_raw(field.name)
+            return name
 
     def enum_variant_name_raw(self, name):
-        name = fmt_pascal(name)
-        if name in RUST_RESERVED_WORDS:
-            name += 'Variant'
-        return name
+        try:
+            return self._enum_variant_names[name]
+        except KeyError:
+            pass
+        rust_name = _fmt_pascal(name)
+        if rust_name in RUST_RESERVED_WORDS:
+            rust_name += 'Variant'
+        self._enum_variant_names[name] = rust_name
+        return rust_name
 
     def route_name(self, route):
-        return self.route_name_raw(route.name, route.version)
+        try:
+            return route._rust_route_name
+        except AttributeError:
+            name = route._rust_route_name = self.route_name_raw(route.name, route.version)
+            return name
 
     def route_name_raw(self, name, version):
-        name = fmt_underscores(name)
+        try:
+            return self._route_names[name, version]
+        except KeyError:
+            pass
+        rust_name = _fmt_underscores(name)
         if version > 1:
-            name = '{}_v{}'.format(name, version)
-        if name in RUST_RESERVED_WORDS:
-            name = 'do_' + name
-        return name
+            rust_name = '%s_v%s' % (rust_name, version)
+        if rust_name in RUST_RESERVED_WORDS:
+            rust_name = 'do_' + rust_name
+        self._route_names[name, version] = rust_name
+        return rust_name
 
     def alias_name(self, alias):
-        name = fmt_pascal(alias.name)
-        if name in RUST_RESERVED_WORDS + RUST_GLOBAL_NAMESPACE:
+        try:
+            return alias._rust_alias_name
+        except AttributeError:
+            name = alias._rust_alias_name = self.alias_name_raw(alias.name)
+            return name
+
+    def alias_name_raw(self, alias_name):
+        try:
+            return self._alias_names[alias_name]
+        except KeyError:
+            pass
+        name = _fmt_pascal(alias_name)
+        if name in RUST_RESERVED_TYPE_NAMES:
             name += 'Alias'
+        self._alias_names[alias_name] = name
         return name
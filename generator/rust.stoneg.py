@@ -1,4 +1,6 @@
 from contextlib import contextmanager
+import multiprocessing
+import os
 
 from rust import RustHelperBackend
 from stone import ir
@@ -9,19 +11,261 @@ def fmt_shouting_snake(name):
     return '_'.join([word.upper() for word in split_words(name)])
 
 
+# Templates for the code emitted for every route.
+_ROUTE_CLIENT_ARG = u'client: &impl %s'
+_ROUTE_ARG = u'arg: &%s'
+_ROUTE_RESULT = u'crate::Result<Result<%s, %s>>'
+_ROUTE_DOWNLOAD_RESULT = \
+    u'crate::Result<Result<crate::client_trait::HttpRequestResult<%s>, %s>>'
+_ROUTE_PATH = u'"%s/%s"'
+
+# Route 'host' attribute -> the Endpoint to send it to.
+_ROUTE_ENDPOINTS = {
+    'api': u'crate::client_trait::Endpoint::Api',
+    'content': u'crate::client_trait::Endpoint::Content',
+    'notify': u'crate::client_trait::Endpoint::Notify',
+}
+
+# Route 'auth' attribute (sorted) -> the client trait the route function takes. The ('app', 'user')
+# case gets two functions, and is handled in _emit_route.
+_ROUTE_AUTH_TRAITS = {
+    ('user',): u'crate::client_trait::UserAuthClient',
+    ('team',): u'crate::client_trait::TeamAuthClient',
+    ('app',): u'crate::client_trait::AppAuthClient',
+    ('noauth',): u'crate::client_trait::NoauthClient',
+}
+
+# Route 'style' attribute -> (client_helpers function to call, Style to pass it, extra function
+# parameters, extra arguments to pass after the route argument, result type template).
+_ROUTE_STYLES = {
+    'rpc': (
+        u'crate::client_helpers::request',
+        u'crate::client_trait::Style::Rpc',
+        [],
+        [u'None'],
+        _ROUTE_RESULT),
+    'download': (
+        u'crate::client_helpers::request_with_body',
+        u'crate::client_trait::Style::Download',
+        [u'range_start: Option<u64>', u'range_end: Option<u64>'],
+        [u'None', u'range_start', u'range_end'],
+        _ROUTE_DOWNLOAD_RESULT),
+    'upload': (
+        u'crate::client_helpers::request',
+        u'crate::client_trait::Style::Upload',
+        [u'body: &[u8]'],
+        [u'Some(body)'],
+        _ROUTE_RESULT),
+}
+
+# Template for one arm of the `match key` in a struct's internal_deserialize; takes the field's
+# name in the spec and its Rust name.
+_DESERIALIZE_FIELD_ARM = (
+    u'        "%(name)s" => {\n'
+    u'            if field_%(field)s.is_some() {\n'
+    u'                return Err(::serde::de::Error::duplicate_field("%(name)s"));\n'
+    u'            }\n'
+    u'            field_%(field)s = Some(map.next_value()?);\n'
+    u'        }\n')
+
+# The loop in a struct's deserializer that reads its fields from the map, one
+# _DESERIALIZE_FIELD_ARM per field.
+_DESERIALIZE_FIELDS_LOOP = (
+    u'while let Some(key) = map.next_key::<&str>()? {\n'
+    u'%(nothing)s'
+    u'    match key {\n'
+    u'%(arms)s'
+    u'        _ => {\n'
+    u'            // unknown field allowed and ignored\n'
+    u'            map.next_value::<::serde_json::Value>()?;\n'
+    u'        }\n'
+    u'    }\n'
+    u'}')
+
+# The Rust types for IR primitive types, by exact IR class.
+_RUST_PRIMITIVE_TYPES = {
+    ir.Void: u'()',
+    ir.Bytes: u'Vec<u8>',
+    ir.Int32: u'i32',
+    ir.UInt32: u'u32',
+    ir.Int64: u'i64',
+    ir.UInt64: u'u64',
+    ir.Float32: u'f32',
+    ir.Float64: u'f64',
+    ir.Boolean: u'bool',
+    ir.String: u'String',
+    ir.Timestamp: u'String /*Timestamp*/',  # TODO
+}
+
+# Kinds of fields, which determine how they get (de)serialized. _classify_fields() stores one of
+# these in each field's _rust_kind attribute.
+# Struct fields:
+_NULLABLE_FIELD = 0
+_EMPTY_STRING_FIELD = 1         # a String which defaults to ""
+_PRIMITIVE_DEFAULT_FIELD = 2    # a primitive type with a default
+_DEFAULT_FIELD = 3              # any other type with a default
+_REQUIRED_FIELD = 4
+# Union variants:
+_VOID_VARIANT = 5
+_STRUCT_VARIANT = 6             # a non-polymorphic struct
+_NULLABLE_STRUCT_VARIANT = 7
+_ENUM_VARIANT = 8               # a union or polymorphic struct
+_NULLABLE_ENUM_VARIANT = 9
+_PRIMITIVE_VARIANT = 10         # anything else
+_NULLABLE_PRIMITIVE_VARIANT = 11
+
+_NULLABLE_VARIANTS = frozenset([
+    _NULLABLE_STRUCT_VARIANT, _NULLABLE_ENUM_VARIANT, _NULLABLE_PRIMITIVE_VARIANT])
+
+# Templates for the fields of the struct literal at the end of internal_deserialize, by kind.
+# _PRIMITIVE_DEFAULT_FIELD is also used for other defaults which are "trivial" values.
+_FIELD_INITIALIZERS = {
+    _NULLABLE_FIELD: u'%(field)s: field_%(field)s,',
+    _EMPTY_STRING_FIELD: u'%(field)s: field_%(field)s.unwrap_or_else(String::new),',
+    _PRIMITIVE_DEFAULT_FIELD: u'%(field)s: field_%(field)s.unwrap_or(%(default)s),',
+    _DEFAULT_FIELD: u'%(field)s: field_%(field)s.unwrap_or_else(|| %(default)s),',
+    _REQUIRED_FIELD: u'%(field)s: field_%(field)s.ok_or_else(|| '
+                     u'::serde::de::Error::missing_field("%(name)s"))?,',
+}
+
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+
+
+# The backend that pool workers render namespaces with. RustBackend.generate() sets this before
+# forking the workers, so they inherit it (and the API) instead of having it pickled.
+_worker_backend = None
+
+
+def _render_namespace_in_worker(ns_name):
+    backend = _worker_backend
+    return backend._render_namespace(backend._namespaces[ns_name])
+
+
+class _NestedBlocks(object):
+    """
+    A context manager which enters the given context managers in order, and exits them in
+    reverse order; used for emitting a block directly inside another one.
+    """
+
+    __slots__ = ('ctxs',)
+
+    def __init__(self, *ctxs):
+        self.ctxs = ctxs
+
+    def __enter__(self):
+        for ctx in self.ctxs:
+            ctx.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for ctx in reversed(self.ctxs):
+            ctx.__exit__(exc_type, exc_value, traceback)
+        return False
+
+
 class RustBackend(RustHelperBackend):
     def __init__(self, target_folder_path, args):
         super(RustBackend, self).__init__(target_folder_path, args)
         self._modules = []
+        self._buf = bytearray()
+        # Memoized results of _rust_type(), keyed by (id(typ), no_qualify). These depend on the
+        # current namespace, so this gets reset for each one.
+        self._rust_types = {}
+        # Output of _emit_wrapped_doc(), keyed by (text, prefix, indent).
+        self._wrapped_docs = {}
+        # _rust_type() handlers for the non-primitive types, by exact IR class.
+        self._rust_type_handlers = {
+            ir.Nullable: self._rust_nullable_type,
+            ir.List: self._rust_list_type,
+            ir.Map: self._rust_map_type,
+            ir.Alias: self._rust_alias_type,
+            ir.Struct: self._rust_struct_type,
+            ir.Union: self._rust_union_type,
+        }
         self.preserve_aliases = True
 
+    # Output Buffer
+
+    # The base backend keeps a list of brace-escaped strings per output file and runs them all
+    # through str.format() when the file is flushed. We never use placeholders, so instead keep
+    # one UTF-8 bytearray per file and write it out as-is.
+
+    @contextmanager
+    def output_to_relative_path(self, relative_path):
+        self._buf = bytearray()
+        yield
+        self._write_file(relative_path, self._buf)
+        self._buf = bytearray()
+
+    def _write_file(self, relative_path, contents):
+        full_path = os.path.join(self.target_folder_path, relative_path)
+        directory = os.path.dirname(full_path)
+        if not os.path.exists(directory):
+            self.logger.info('Creating %s', directory)
+            os.makedirs(directory)
+
+        self.logger.info('Generating %s', full_path)
+        # The contents are already encoded, so skip the buffered file object and hand the whole
+        # thing to the OS (in one call, unless it does a short write).
+        fd = os.open(full_path, _WRITE_FLAGS, 0o666)
+        try:
+            remaining = memoryview(contents)
+            while remaining:
+                remaining = remaining[os.write(fd, remaining):]
+        finally:
+            os.close(fd)
+
+    def emit_raw(self, s):
+        self._buf += s.encode('utf-8')
+
+    def emit(self, s=u''):
+        if s:
+            self._buf += (u' ' * self.cur_indent + s + u'\n').encode('utf-8')
+        else:
+            self._buf += b'\n'
+
+    def _emit_chunk(self, chunk):
+        """
+        Emit a pre-formatted chunk of one or more lines, all indented by the current indent.
+        """
+        indent = u' ' * self.cur_indent
+        self._buf += (indent + chunk.replace(u'\n', u'\n' + indent) + u'\n').encode('utf-8')
+
+    @contextmanager
+    def block(self, before=u'', after=u'', delim=(u'{', u'}')):
+        indent = u' ' * self.cur_indent
+        if before:
+            self._buf += (indent + before + u' ' + delim[0] + u'\n').encode('utf-8')
+        else:
+            self._buf += (indent + delim[0] + u'\n').encode('utf-8')
+        self.cur_indent += 4
+        yield
+        self.cur_indent -= 4
+        self._buf += (indent + delim[1] + after + u'\n').encode('utf-8')
+
     # File Generators
 
     def generate(self, api):
+        global _worker_backend
+        self._namespaces = api.namespaces
         self._all_types = {ns.name: {typ.name: typ for typ in ns.data_types}
                            for ns in api.namespaces.values()}
-        for namespace in api.namespaces.values():
-            self._emit_namespace(namespace)
+
+        # Each namespace's module is independent of the others, so render them in parallel when
+        # we can fork worker processes, and then write them out here in order.
+        ns_names = list(api.namespaces.keys())
+        if len(ns_names) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            _worker_backend = self
+            try:
+                with multiprocessing.get_context('fork').Pool() as pool:
+                    rendered = pool.map(_render_namespace_in_worker, ns_names, chunksize=1)
+            finally:
+                _worker_backend = None
+        else:
+            rendered = [self._render_namespace(ns) for ns in api.namespaces.values()]
+
+        for ns_name, (relative_path, contents) in zip(ns_names, rendered):
+            self._write_file(relative_path, contents)
+            self._modules.append(ns_name)
         self._generate_mod_file()
 
     def _generate_mod_file(self):
@@ -30,7 +274,7 @@ class RustBackend(RustHelperBackend):
             self.emit(u'#![allow(missing_docs)]')
             self.emit()
             for module in self._modules:
-                self.emit(u'if_feature! {{ "dbx_{}", pub mod {}; }}'.format(
+                self.emit(u'if_feature! { "dbx_%s", pub mod %s; }' % (
                     module, self.namespace_name_raw(module)))
                 self.emit()
             with self.block(u'pub(crate) fn eat_json_fields<\'de, V>(map: &mut V)'
@@ -42,38 +286,83 @@ class RustBackend(RustHelperBackend):
 
     # Type Emitters
 
-    def _emit_namespace(self, namespace):
+    def _render_namespace(self, namespace):
+        """
+        Emit the module for the given namespace, and return its file name and contents.
+        """
         ns = self.namespace_name(namespace)
-        with self.output_to_relative_path(ns + '.rs'):
-            self._current_namespace = namespace.name
-            self._emit_header()
+        self._buf = bytearray()
+        self._current_namespace = namespace.name
+        self._rust_types = {}
+        self._classify_fields(namespace)
+        self._emit_header()
 
-            if namespace.doc is not None:
-                self._emit_doc(namespace.doc, prefix=u'//!')
-                self.emit()
+        if namespace.doc is not None:
+            self._emit_doc(namespace.doc, prefix=u'//!')
+            self.emit()
 
-            for alias in namespace.aliases:
-                self._emit_alias(alias)
-            if namespace.aliases:
-                self.emit()
+        for alias in namespace.aliases:
+            self._emit_alias(alias)
+        if namespace.aliases:
+            self.emit()
 
-            for fn in namespace.routes:
-                self._emit_route(ns, fn)
+        for fn in namespace.routes:
+            self._emit_route(ns, fn)
 
-            for typ in namespace.data_types:
-                self._current_type = typ
-                if isinstance(typ, ir.Struct):
-                    if typ.has_enumerated_subtypes():
-                        self._emit_polymorphic_struct(typ)
-                    else:
-                        self._emit_struct(typ)
-                elif isinstance(typ, ir.Union):
-                    self._emit_union(typ)
+        for typ in namespace.data_types:
+            self._current_type = typ
+            if isinstance(typ, ir.Struct):
+                if typ.has_enumerated_subtypes():
+                    self._emit_polymorphic_struct(typ)
                 else:
-                    raise RuntimeError('WARNING: unhandled type "{}" of field "{}"'
-                                       .format(type(typ).__name__, typ.name))
+                    self._emit_struct(typ)
+            elif isinstance(typ, ir.Union):
+                self._emit_union(typ)
+            else:
+                raise RuntimeError('WARNING: unhandled type "%s" of field "%s"'
+                                   % (type(typ).__name__, typ.name))
+
+        contents = bytes(self._buf)
+        self._buf = bytearray()
+        return ns + '.rs', contents
+
+    def _classify_fields(self, namespace):
+        """
+        Set _rust_kind on the fields of all the namespace's structs and unions, including
+        inherited ones.
+        """
+        for typ in namespace.data_types:
+            if isinstance(typ, ir.Union):
+                for field in typ.all_fields:
+                    field._rust_kind = self._variant_kind(field)
+            else:
+                for field in typ.all_fields:
+                    field._rust_kind = self._field_kind(field)
+
+    def _field_kind(self, field):
+        if isinstance(field.data_type, ir.Nullable):
+            return _NULLABLE_FIELD
+        elif field.has_default:
+            if isinstance(field.data_type, ir.String) and not field.default:
+                return _EMPTY_STRING_FIELD
+            elif ir.is_primitive_type(ir.unwrap_aliases(field.data_type)[0]):
+                return _PRIMITIVE_DEFAULT_FIELD
+            else:
+                return _DEFAULT_FIELD
+        else:
+            return _REQUIRED_FIELD
 
-        self._modules.append(namespace.name)
+    def _variant_kind(self, field):
+        if isinstance(field.data_type, ir.Void):
+            return _VOID_VARIANT
+        ultimate_type = ir.unwrap(field.data_type)[0]
+        nullable = isinstance(ir.unwrap_aliases(field.data_type)[0], ir.Nullable)
+        if self.is_enum_type(ultimate_type):
+            return _NULLABLE_ENUM_VARIANT if nullable else _ENUM_VARIANT
+        elif isinstance(ultimate_type, ir.Struct):
+            return _NULLABLE_STRUCT_VARIANT if nullable else _STRUCT_VARIANT
+        else:
+            return _NULLABLE_PRIMITIVE_VARIANT if nullable else _PRIMITIVE_VARIANT
 
     def _emit_header(self):
         self.emit(u'// DO NOT EDIT')
@@ -88,34 +377,38 @@ class RustBackend(RustHelperBackend):
 
     def _emit_struct(self, struct):
         struct_name = self.struct_name(struct)
+        # (field, Rust field name) for the required fields, the optional ones, and all of them
+        # (in the same order as struct.all_fields), shared by all the emitters below. Stone
+        # recomputes these lists by walking the supertypes on every access.
+        required_fields = [(field, self.field_name(field)) for field in struct.all_required_fields]
+        optional_fields = [(field, self.field_name(field)) for field in struct.all_optional_fields]
+        fields = required_fields + optional_fields
         self._emit_doc(struct.doc)
         self.emit(u'#[derive(Debug)]')
-        with self.block(u'pub struct {}'.format(struct_name)):
-            for field in struct.all_fields:
+        with self.block(u'pub struct %s' % struct_name):
+            for field, field_name in fields:
                 self._emit_doc(field.doc)
-                self.emit(u'pub {}: {},'.format(
-                    self.field_name(field),
-                    self._rust_type(field.data_type)))
+                self.emit(u'pub %s: %s,' % (field_name, self._field_type_str(field)))
         self.emit()
 
-        if not struct.all_required_fields:
-            self._impl_default_for_struct(struct)
+        if not required_fields:
+            self._impl_default_for_struct(struct, fields)
             self.emit()
 
-        if struct.all_required_fields or struct.all_optional_fields:
+        if fields:
             with self._impl_struct(struct):
-                self._emit_new_for_struct(struct)
+                self._emit_new_for_struct(struct, required_fields, optional_fields)
             self.emit()
 
-        self._impl_serde_for_struct(struct)
+        self._impl_serde_for_struct(struct, fields, required_fields)
 
     def _emit_polymorphic_struct(self, struct):
         enum_name = self.enum_name(struct)
         self._emit_doc(struct.doc)
         self.emit(u'#[derive(Debug)]')
-        with self.block(u'pub enum {}'.format(enum_name)):
+        with self.block(u'pub enum %s' % enum_name):
             for subtype in struct.get_enumerated_subtypes():
-                self.emit(u'{}({}),'.format(
+                self.emit(u'%s(%s),' % (
                     self.enum_variant_name(subtype),
                     self._rust_type(subtype.data_type)))
             if struct.is_catch_all():
@@ -126,56 +419,53 @@ class RustBackend(RustHelperBackend):
 
     def _emit_union(self, union):
         enum_name = self.enum_name(union)
+        # (field, Rust variant name, ultimate type) for all but the catch-all field, which is
+        # always handled as the 'Other' variant at the end.
+        variants = [(field, self.enum_variant_name(field), ir.unwrap(field.data_type)[0])
+                    for field in union.all_fields if not field.catch_all]
         self._emit_doc(union.doc)
         self.emit(u'#[derive(Debug)]')
-        with self.block(u'pub enum {}'.format(enum_name)):
-            for field in union.all_fields:
-                if field.catch_all:
-                    # Handle the 'Other' variant at the end.
-                    continue
+        with self.block(u'pub enum %s' % enum_name):
+            for field, variant_name, _ in variants:
                 self._emit_doc(field.doc)
-                variant_name = self.enum_variant_name(field)
                 if isinstance(field.data_type, ir.Void):
-                    self.emit(u'{},'.format(variant_name))
+                    self.emit(u'%s,' % variant_name)
                 else:
-                    self.emit(u'{}({}),'.format(variant_name, self._rust_type(field.data_type)))
+                    self.emit(u'%s(%s),' % (variant_name, self._field_type_str(field)))
             if not union.closed:
-                self.emit_wrapped_text(
+                self._emit_wrapped_doc(
                         u'Catch-all used for unrecognized values returned from the server.'
                         u' Encountering this value typically indicates that this SDK version is'
                         u' out of date.',
-                        prefix=u'/// ', width=100)
+                        u'/// ')
                 self.emit(u'Other,')
         self.emit()
 
-        self._impl_serde_for_union(union)
+        self._impl_serde_for_union(union, variants)
 
         if union.name.endswith('Error'):
             self._impl_error(enum_name)
 
     def _emit_route(self, ns, fn, auth_trait = None):
         route_name = self.route_name(fn)
-        host = fn.attrs.get('host', 'api')
-        if host == 'api':
-            endpoint = u'crate::client_trait::Endpoint::Api'
-        elif host == 'content':
-            endpoint = u'crate::client_trait::Endpoint::Content'
-        elif host == 'notify':
-            endpoint = u'crate::client_trait::Endpoint::Notify'
+
+        # This is the name of the HTTP route. Almost the same as the 'route_name', but without any
+        # mangling to avoid Rust keywords and such.
+        if fn.version > 1:
+            name_with_version = "%s_v%s" % (fn.name, fn.version)
         else:
-            raise RuntimeError(u'ERROR: unsupported endpoint: {}'.format(host))
+            name_with_version = fn.name
+
+        host = fn.attrs.get('host', 'api')
+        try:
+            endpoint = _ROUTE_ENDPOINTS[host]
+        except KeyError:
+            raise RuntimeError(u'ERROR: unsupported endpoint: %s' % host)
 
         if auth_trait is None:
             auths_str = fn.attrs.get('auth', 'user')
-            auths = list(map(lambda s: s.strip(), auths_str.split(',')))
-            auths.sort()
-            if auths == ['user']:
-                auth_trait = u'crate::client_trait::UserAuthClient'
-            elif auths == ['team']:
-                auth_trait = u'crate::client_trait::TeamAuthClient'
-            elif auths == ['app']:
-                auth_trait = u'crate::client_trait::AppAuthClient'
-            elif auths == ['app', 'user']:
+            auths = tuple(sorted(s.strip() for s in auths_str.split(',')))
+            if auths == ('app', 'user'):
                 # This is kind of lame, but there's no way to have a marker trait for either User
                 # OR App auth, so to get around this, we'll emit two functions, one for each.
 
@@ -185,93 +475,49 @@ class RustBackend(RustHelperBackend):
                 # Now modify the name to add a suffix, and emit the App auth version by continuing.
                 route_name += "_app_auth"
                 auth_trait = u'crate::client_trait::AppAuthClient'
-            elif auths == ['noauth']:
-                auth_trait = u'crate::client_trait::NoauthClient'
             else:
-                raise Exception('route {}/{}: unsupported auth type(s): {}'.format(
-                    ns, name_with_version, auths_str))
+                try:
+                    auth_trait = _ROUTE_AUTH_TRAITS[auths]
+                except KeyError:
+                    raise Exception('route %s/%s: unsupported auth type(s): %s' % (
+                        ns, name_with_version, auths_str))
 
-        # This is the name of the HTTP route. Almost the same as the 'route_name', but without any
-        # mangling to avoid Rust keywords and such.
-        if fn.version > 1:
-            name_with_version = "{}_v{}".format(fn.name, fn.version)
-        else:
-            name_with_version = fn.name
+        style = fn.attrs.get('style', 'rpc')
+        try:
+            helper, style_variant, extra_params, extra_args, result_type = _ROUTE_STYLES[style]
+        except KeyError:
+            raise RuntimeError(u'ERROR: unknown route style: %s' % style)
 
         self._emit_doc(fn.doc)
 
         arg_void = isinstance(fn.arg_data_type, ir.Void)
-        style = fn.attrs.get('style', 'rpc')
-        if style == 'rpc':
-            with self.emit_rust_function_def(
-                    route_name,
-                    [u'client: &impl {}'.format(auth_trait)]
-                        + ([] if arg_void else
-                            [u'arg: &{}'.format(self._rust_type(fn.arg_data_type))]),
-                    u'crate::Result<Result<{}, {}>>'.format(
-                        self._rust_type(fn.result_data_type),
-                        self._rust_type(fn.error_data_type)),
-                    access=u'pub'):
-                self.emit_rust_fn_call(
-                    u'crate::client_helpers::request',
-                    [u'client',
-                        endpoint,
-                        u'crate::client_trait::Style::Rpc',
-                        u'"{}/{}"'.format(ns, name_with_version),
-                        u'&()' if arg_void else u'arg',
-                        u'None'])
-        elif style == 'download':
-            with self.emit_rust_function_def(
-                    route_name,
-                    [u'client: &impl {}'.format(auth_trait)]
-                        + ([] if arg_void else
-                            [u'arg: &{}'.format(self._rust_type(fn.arg_data_type))])
-                        + [u'range_start: Option<u64>',
-                            u'range_end: Option<u64>'],
-                    u'crate::Result<Result<crate::client_trait::HttpRequestResult<{}>, {}>>'.format(
-                        self._rust_type(fn.result_data_type),
-                        self._rust_type(fn.error_data_type)),
-                    access=u'pub'):
-                self.emit_rust_fn_call(
-                    u'crate::client_helpers::request_with_body',
-                    [u'client',
-                        endpoint,
-                        u'crate::client_trait::Style::Download',
-                        u'"{}/{}"'.format(ns, name_with_version),
-                        u'&()' if arg_void else u'arg',
-                        u'None',
-                        u'range_start',
-                        u'range_end'])
-        elif style == 'upload':
-            with self.emit_rust_function_def(
-                    route_name,
-                    [u'client: &impl {}'.format(auth_trait)]
-                        + ([] if arg_void else
-                            [u'arg: &{}'.format(self._rust_type(fn.arg_data_type))])
-                        + [u'body: &[u8]'],
-                    u'crate::Result<Result<{}, {}>>'.format(
-                        self._rust_type(fn.result_data_type),
-                        self._rust_type(fn.error_data_type)),
-                    access=u'pub'):
-                self.emit_rust_fn_call(
-                    u'crate::client_helpers::request',
-                    [u'client',
-                        endpoint,
-                        u'crate::client_trait::Style::Upload',
-                        u'"{}/{}"'.format(ns, name_with_version),
-                        u'&()' if arg_void else u'arg',
-                        u'Some(body)'])
-        else:
-            raise RuntimeError(u'ERROR: unknown route style: {}'.format(style))
+        with self.emit_rust_function_def(
+                route_name,
+                [_ROUTE_CLIENT_ARG % auth_trait]
+                    + ([] if arg_void else
+                        [_ROUTE_ARG % self._rust_type(fn.arg_data_type)])
+                    + extra_params,
+                result_type % (
+                    self._rust_type(fn.result_data_type),
+                    self._rust_type(fn.error_data_type)),
+                access=u'pub'):
+            self.emit_rust_fn_call(
+                helper,
+                [u'client',
+                    endpoint,
+                    style_variant,
+                    _ROUTE_PATH % (ns, name_with_version),
+                    u'&()' if arg_void else u'arg']
+                    + extra_args)
         self.emit()
 
     def _emit_alias(self, alias):
         alias_name = self.alias_name(alias)
-        self.emit(u'pub type {} = {};'.format(alias_name, self._rust_type(alias.data_type)))
+        self.emit(u'pub type %s = %s;' % (alias_name, self._field_type_str(alias)))
 
     # Serialization
 
-    def _impl_serde_for_struct(self, struct):
+    def _impl_serde_for_struct(self, struct, fields, required_fields):
         """
         Emit internal_deserialize() and possibly internal_deserialize_opt().
         internal_deserialize[_opt] takes a map and deserializes it into the struct. It reads the
@@ -283,17 +529,15 @@ class RustBackend(RustHelperBackend):
         only emitted for types which have at least one required field, because if all fields are
         optional, there's no way to differentiate between a null value and one where all fields
         are default.
+        `fields` is a list of (field, Rust field name) for all the struct's fields, and
+        `required_fields` the same for just its required ones.
         """
 
         type_name = self.struct_name(struct)
-        field_list_name = u'{}_FIELDS'.format(fmt_shouting_snake(struct.name))
-        self.generate_multiline_list(
-            list(u'"{}"'.format(field.name) for field in struct.all_fields),
-            before='const {}: &[&str] = &'.format(field_list_name),
-            after=';',
-            delim=(u'[', u']'))
+        field_list_name = u'%s_FIELDS' % fmt_shouting_snake(struct.name)
+        self._emit_names_const(field_list_name, [field.name for field, _ in fields])
         # Only emit the _opt deserializer if there are required fields.
-        optional = len(struct.all_required_fields) > 0
+        optional = len(required_fields) > 0
         with self._impl_struct(struct):
             if optional:
                 # Convenience wrapper around _opt for the more common case where the struct is
@@ -301,7 +545,7 @@ class RustBackend(RustHelperBackend):
                 with self.emit_rust_function_def(
                         u'internal_deserialize<\'de, V: ::serde::de::MapAccess<\'de>>',
                         [u'map: V'],
-                        u'Result<{}, V::Error>'.format(type_name),
+                        u'Result<%s, V::Error>' % type_name,
                         access=u'pub(crate)'):
                     self.emit(u'Self::internal_deserialize_opt(map, false)'
                               u'.map(Option::unwrap)')
@@ -313,75 +557,55 @@ class RustBackend(RustHelperBackend):
                     + u'<\'de, V: ::serde::de::MapAccess<\'de>>',
                     [u'mut map: V']
                     + ([u'optional: bool'] if optional else []),
-                    (u'Result<Option<{}>, V::Error>' if optional else u'Result<{}, V::Error>')
-                    .format(type_name),
+                    (u'Result<Option<%s>, V::Error>' if optional else u'Result<%s, V::Error>')
+                    % type_name,
                     access=u'pub(crate)'):
-                if len(struct.all_fields) == 0:
+                if not fields:
                     self.emit(u'// ignore any fields found; none are presently recognized')
                     self.emit(u'crate::eat_json_fields(&mut map)?;')
                     if optional:
                         self.emit(u'Ok(None)')
                     else:
-                        self.emit(u'Ok({} {{}})'.format(type_name))
+                        self.emit(u'Ok(%s {})' % type_name)
                 else:
-                    for field in struct.all_fields:
-                        self.emit(u'let mut field_{} = None;'.format(self.field_name(field)))
+                    for _, field_name in fields:
+                        self.emit(u'let mut field_%s = None;' % field_name)
                     if optional:
                         self.emit(u'let mut nothing = true;')
-                    with self.block(u'while let Some(key) = map.next_key::<&str>()?'):
-                        if optional:
-                            self.emit(u'nothing = false;')
-                        with self.block(u'match key'):
-                            for field in struct.all_fields:
-                                field_name = self.field_name(field)
-                                with self.block(u'"{}" =>'.format(field.name)):
-                                    with self.block(u'if field_{}.is_some()'.format(field_name)):
-                                        self.emit(u'return Err(::serde::de::Error::duplicate_field('
-                                                  u'"{}"));'
-                                                  .format(field.name))
-                                    self.emit(u'field_{} = Some(map.next_value()?);'
-                                              .format(field_name))
-                            with self.block(u'_ =>'):
-                                self.emit(u'// unknown field allowed and ignored')
-                                self.emit(u'map.next_value::<::serde_json::Value>()?;')
+                    self._emit_chunk(_DESERIALIZE_FIELDS_LOOP % {
+                        'nothing': u'    nothing = false;\n' if optional else u'',
+                        'arms': u''.join([_DESERIALIZE_FIELD_ARM % {
+                            'name': field.name,
+                            'field': field_name,
+                        } for field, field_name in fields]),
+                    })
                     if optional:
                         with self.block(u'if optional && nothing'):
                             self.emit(u'return Ok(None);')
-                    with self.block(u'let result = {}'.format(type_name), delim=(u'{', u'};')):
-                        for field in struct.all_fields:
-                            field_name = self.field_name(field)
-                            if isinstance(field.data_type, ir.Nullable):
-                                self.emit(u'{}: field_{},'.format(field_name, field_name))
-                            elif field.has_default:
+                    with self.block(u'let result = %s' % type_name, delim=(u'{', u'};')):
+                        for field, field_name in fields:
+                            kind = field._rust_kind
+                            default_value = None
+                            if kind == _PRIMITIVE_DEFAULT_FIELD:
                                 default_value = self._default_value(field)
-                                if isinstance(field.data_type, ir.String) \
-                                        and not field.default:
-                                    self.emit(u'{}: field_{}.unwrap_or_else(String::new),'
-                                              .format(field_name, field_name))
-                                elif (ir.is_primitive_type(ir.unwrap_aliases(field.data_type)[0])
-                                        # Also, as a rough but effective heuristic, consider values
-                                        # that have no parentheses in them to be "trivial", and
-                                        # don't enclose them in a closure. This avoids running
-                                        # afoul of the clippy::unnecessary_lazy_evaluations lint.
-                                        or not "(" in default_value):
-                                    self.emit(u'{}: field_{}.unwrap_or({}),'
-                                              .format(field_name,
-                                                      field_name,
-                                                      default_value))
-                                else:
-                                    self.emit(u'{}: field_{}.unwrap_or_else(|| {}),'
-                                              .format(field_name,
-                                                      field_name,
-                                                      default_value))
-                            else:
-                                self.emit(u'{}: field_{}.ok_or_else(|| '
-                                          u'::serde::de::Error::missing_field("{}"))?,'
-                                          .format(field_name, field_name, field.name))
+                            elif kind == _DEFAULT_FIELD:
+                                default_value = self._default_value(field)
+                                # Also, as a rough but effective heuristic, consider values that
+                                # have no parentheses in them to be "trivial", and don't enclose
+                                # them in a closure. This avoids running afoul of the
+                                # clippy::unnecessary_lazy_evaluations lint.
+                                if not "(" in default_value:
+                                    kind = _PRIMITIVE_DEFAULT_FIELD
+                            self.emit(_FIELD_INITIALIZERS[kind] % {
+                                'field': field_name,
+                                'name': field.name,
+                                'default': default_value,
+                            })
                     if optional:
                         self.emit(u'Ok(Some(result))')
                     else:
                         self.emit(u'Ok(result)')
-            if struct.all_fields:
+            if fields:
                 self.emit()
                 with self.emit_rust_function_def(
                         u'internal_serialize<S: ::serde::ser::Serializer>',
@@ -389,43 +613,39 @@ class RustBackend(RustHelperBackend):
                         u'Result<(), S::Error>',
                         access=u'pub(crate)'):
                     self.emit(u'use serde::ser::SerializeStruct;')
-                    self.generate_multiline_list(
-                        list(u's.serialize_field("{}", &self.{})'
-                             .format(field.name, self.field_name(field))
-                             for field in struct.all_fields),
-                        delim=(u'', u''),
-                        sep='?;',
-                        skip_last_sep=True)
+                    self._emit_chunk(u'?;\n'.join(
+                        u's.serialize_field("%s", &self.%s)' % (field.name, field_name)
+                        for field, field_name in fields))
         self.emit()
-        with self._impl_deserialize(self.struct_name(struct)):
+        with self._impl_deserialize(type_name):
             self.emit(u'// struct deserializer')
             self.emit(u'use serde::de::{MapAccess, Visitor};')
             self.emit(u'struct StructVisitor;')
             with self.block(u'impl<\'de> Visitor<\'de> for StructVisitor'):
-                self.emit(u'type Value = {};'.format(type_name))
+                self.emit(u'type Value = %s;' % type_name)
                 with self.emit_rust_function_def(
                         u'expecting',
                         [u'&self', u'f: &mut ::std::fmt::Formatter<\'_>'],
                         u'::std::fmt::Result'):
-                    self.emit(u'f.write_str("a {} struct")'.format(struct.name))
+                    self.emit(u'f.write_str("a %s struct")' % struct.name)
                 with self.emit_rust_function_def(
                         u'visit_map<V: MapAccess<\'de>>',
                         [u'self', u'map: V'],
                         u'Result<Self::Value, V::Error>'):
-                    self.emit(u'{}::internal_deserialize(map)'.format(type_name))
-            self.emit(u'deserializer.deserialize_struct("{}", {}, StructVisitor)'
-                      .format(struct.name,
-                              field_list_name))
+                    self.emit(u'%s::internal_deserialize(map)' % type_name)
+            self.emit(u'deserializer.deserialize_struct("%s", %s, StructVisitor)'
+                      % (struct.name,
+                         field_list_name))
         self.emit()
         with self._impl_serialize(type_name):
             self.emit(u'// struct serializer')
             self.emit(u'use serde::ser::SerializeStruct;')
-            if not struct.all_fields:
-                self.emit(u'serializer.serialize_struct("{}", 0)?.end()'.format(struct.name))
+            if not fields:
+                self.emit(u'serializer.serialize_struct("%s", 0)?.end()' % struct.name)
             else:
-                self.emit(u'let mut s = serializer.serialize_struct("{}", {})?;'
-                          .format(struct.name,
-                                  len(struct.all_fields)))
+                self.emit(u'let mut s = serializer.serialize_struct("%s", %s)?;'
+                          % (struct.name,
+                             len(fields)))
                 self.emit(u'self.internal_serialize::<S>(&mut s)?;')
                 self.emit(u's.end()')
         self.emit()
@@ -437,12 +657,12 @@ class RustBackend(RustHelperBackend):
             self.emit(u'use serde::de::{self, MapAccess, Visitor};')
             self.emit(u'struct EnumVisitor;')
             with self.block(u'impl<\'de> Visitor<\'de> for EnumVisitor'):
-                self.emit(u'type Value = {};'.format(type_name))
+                self.emit(u'type Value = %s;' % type_name)
                 with self.emit_rust_function_def(
                         u'expecting',
                         [u'&self', u'f: &mut ::std::fmt::Formatter<\'_>'],
                         u'::std::fmt::Result'):
-                    self.emit(u'f.write_str("a {} structure")'.format(struct.name))
+                    self.emit(u'f.write_str("a %s structure")' % struct.name)
                 with self.emit_rust_function_def(
                         u'visit_map<V: MapAccess<\'de>>',
                         [u'self', u'mut map: V'],
@@ -454,23 +674,23 @@ class RustBackend(RustHelperBackend):
                         for subtype in struct.get_enumerated_subtypes():
                             variant_name = self.enum_variant_name(subtype)
                             if isinstance(subtype.data_type, ir.Void):
-                                self.emit(u'"{}" => Ok({}::{}),'
-                                          .format(subtype.name, type_name, variant_name))
+                                self.emit(u'"%s" => Ok(%s::%s),'
+                                          % (subtype.name, type_name, variant_name))
                             elif isinstance(ir.unwrap_aliases(subtype.data_type)[0], ir.Struct) \
                                     and not subtype.data_type.has_enumerated_subtypes():
-                                self.emit(u'"{}" => Ok({}::{}({}::internal_deserialize(map)?)),'
-                                          .format(subtype.name,
-                                                  type_name,
-                                                  variant_name,
-                                                  self._rust_type(subtype.data_type)))
+                                self.emit(u'"%s" => Ok(%s::%s(%s::internal_deserialize(map)?)),'
+                                          % (subtype.name,
+                                             type_name,
+                                             variant_name,
+                                             self._rust_type(subtype.data_type)))
                             else:
-                                with self.block(u'"{}" =>'.format(subtype.name)):
-                                    with self.block(u'if map.next_key()? != Some("{}")'
-                                                    .format(subtype.name)):
-                                        self.emit(u'Err(de::Error::missing_field("{}"));'
-                                                  .format(subtype.name))
-                                    self.emit(u'Ok({}::{}(map.next_value()?))'
-                                              .format(type_name, variant_name))
+                                with self.block(u'"%s" =>' % subtype.name):
+                                    with self.block(u'if map.next_key()? != Some("%s")'
+                                                    % subtype.name):
+                                        self.emit(u'Err(de::Error::missing_field("%s"));'
+                                                  % subtype.name)
+                                    self.emit(u'Ok(%s::%s(map.next_value()?))'
+                                              % (type_name, variant_name))
                         if struct.is_catch_all():
                             with self.block(u'_ =>'):
                                 # TODO(wfraser): it'd be cool to grab any fields in the parent,
@@ -478,17 +698,13 @@ class RustBackend(RustHelperBackend):
                                 # '_Unknown' enum vaiant.
                                 # For now, just consume them and return a nullary variant.
                                 self.emit(u'crate::eat_json_fields(&mut map)?;')
-                                self.emit(u'Ok({}::_Unknown)'.format(type_name))
+                                self.emit(u'Ok(%s::_Unknown)' % type_name)
                         else:
                             self.emit(u'_ => Err(de::Error::unknown_variant(tag, VARIANTS))')
-            self.generate_multiline_list(
-                list(u'"{}"'.format(subtype.name)
-                     for field in struct.get_enumerated_subtypes()),
-                before='const VARIANTS: &[&str] = &',
-                after=';',
-                delim=(u'[', u']'))
-            self.emit(u'deserializer.deserialize_struct("{}", VARIANTS, EnumVisitor)'.format(
-                struct.name))
+            self._emit_names_const(
+                u'VARIANTS',
+                [subtype.name for field in struct.get_enumerated_subtypes()])
+            self.emit(u'deserializer.deserialize_struct("%s", VARIANTS, EnumVisitor)' % struct.name)
         self.emit()
         with self._impl_serialize(type_name):
             self.emit(u'// polymorphic struct serializer')
@@ -496,34 +712,33 @@ class RustBackend(RustHelperBackend):
             with self.block(u'match *self'):
                 for subtype in struct.get_enumerated_subtypes():
                     variant_name = self.enum_variant_name(subtype)
-                    with self.block(u'{}::{}(ref x) =>'.format(type_name, variant_name)):
-                        self.emit(u'let mut s = serializer.serialize_struct("{}", {})?;'
-                                  .format(type_name, len(subtype.data_type.all_fields) + 1))
-                        self.emit(u's.serialize_field(".tag", "{}")?;'.format(subtype.name))
+                    with self.block(u'%s::%s(ref x) =>' % (type_name, variant_name)):
+                        self.emit(u'let mut s = serializer.serialize_struct("%s", %s)?;'
+                                  % (type_name, len(subtype.data_type.all_fields) + 1))
+                        self.emit(u's.serialize_field(".tag", "%s")?;' % subtype.name)
                         for field in subtype.data_type.all_fields:
-                            self.emit(u's.serialize_field("{}", &x.{})?;'
-                                      .format(field.name,
-                                              self.field_name(field)))
+                            self.emit(u's.serialize_field("%s", &x.%s)?;'
+                                      % (field.name,
+                                         self.field_name(field)))
                         self.emit(u's.end()')
                 if struct.is_catch_all():
-                    self.emit(u'{}::_Unknown => Err(::serde::ser::Error::custom("cannot serialize '
-                              u'unknown variant"))'.format(
-                                    type_name))
+                    self.emit(u'%s::_Unknown => Err(::serde::ser::Error::custom("cannot serialize '
+                              u'unknown variant"))' % type_name)
         self.emit()
 
-    def _impl_serde_for_union(self, union):
+    def _impl_serde_for_union(self, union, variants):
         type_name = self.enum_name(union)
         with self._impl_deserialize(type_name):
             self.emit(u'// union deserializer')
             self.emit(u'use serde::de::{self, MapAccess, Visitor};')
             self.emit(u'struct EnumVisitor;')
             with self.block(u'impl<\'de> Visitor<\'de> for EnumVisitor'):
-                self.emit(u'type Value = {};'.format(type_name))
+                self.emit(u'type Value = %s;' % type_name)
                 with self.emit_rust_function_def(
                         u'expecting',
                         [u'&self', u'f: &mut ::std::fmt::Formatter<\'_>'],
                         u'::std::fmt::Result'):
-                    self.emit(u'f.write_str("a {} structure")'.format(union.name))
+                    self.emit(u'f.write_str("a %s structure")' % union.name)
                 with self.emit_rust_function_def(
                         u'visit_map<V: MapAccess<\'de>>',
                         [u'self', u'mut map: V'],
@@ -535,72 +750,60 @@ class RustBackend(RustHelperBackend):
                         self.emit(u'// open enum with no defined variants')
                         self.emit(u'let _ = tag;') # hax
                         self.emit(u'crate::eat_json_fields(&mut map)?;')
-                        self.emit(u'Ok({}::Other)'.format(type_name))
+                        self.emit(u'Ok(%s::Other)' % type_name)
                     else:
                         with self.block(u'match tag'):
-                            for field in union.all_fields:
-                                if field.catch_all:
-                                    # Handle the 'Other' variant at the end.
-                                    continue
-                                variant_name = self.enum_variant_name(field)
-                                ultimate_type = ir.unwrap(field.data_type)[0]
-                                if isinstance(field.data_type, ir.Void):
-                                    with self.block(u'"{}" =>'.format(field.name)):
+                            for field, variant_name, ultimate_type in variants:
+                                kind = field._rust_kind
+                                if kind == _VOID_VARIANT:
+                                    with self.block(u'"%s" =>' % field.name):
                                         self.emit(u'crate::eat_json_fields(&mut map)?;')
-                                        self.emit(u'Ok({}::{})'.format(type_name, variant_name))
-                                elif isinstance(ultimate_type, ir.Struct) \
-                                        and not ultimate_type.has_enumerated_subtypes():
-                                    if isinstance(ir.unwrap_aliases(field.data_type)[0], ir.Nullable):
-                                        # A nullable here means we might have more fields that can be
-                                        # deserialized into the inner type, or we might have nothing,
-                                        # meaning None.
-                                        if not ultimate_type.all_required_fields:
-                                            raise RuntimeError('{}.{}: an optional struct with no'
-                                                               ' required fields is ambiguous'
-                                                               .format(union.name, field.name))
-                                        self.emit(u'"{}" => Ok({}::{}({}::internal_deserialize_opt('
-                                                  u'map, true)?)),'
-                                                  .format(field.name,
-                                                          type_name,
-                                                          variant_name,
-                                                          self._rust_type(ultimate_type)))
-                                    else:
-                                        self.emit(u'"{}" => Ok({}::{}({}::internal_deserialize(map)?)),'
-                                                  .format(field.name,
-                                                          type_name,
-                                                          variant_name,
-                                                          self._rust_type(field.data_type)))
+                                        self.emit(u'Ok(%s::%s)' % (type_name, variant_name))
+                                elif kind == _NULLABLE_STRUCT_VARIANT:
+                                    # A nullable here means we might have more fields that can be
+                                    # deserialized into the inner type, or we might have nothing,
+                                    # meaning None.
+                                    if not ultimate_type.all_required_fields:
+                                        raise RuntimeError('%s.%s: an optional struct with no'
+                                                           ' required fields is ambiguous'
+                                                           % (union.name, field.name))
+                                    self.emit(u'"%s" => Ok(%s::%s(%s::internal_deserialize_opt('
+                                              u'map, true)?)),'
+                                              % (field.name,
+                                                 type_name,
+                                                 variant_name,
+                                                 self._rust_type(ultimate_type)))
+                                elif kind == _STRUCT_VARIANT:
+                                    self.emit(u'"%s" => Ok(%s::%s(%s::internal_deserialize(map)?)),'
+                                              % (field.name,
+                                                 type_name,
+                                                 variant_name,
+                                                 self._field_type_str(field)))
                                 else:
-                                    with self.block(u'"{}" =>'.format(field.name)):
+                                    with self.block(u'"%s" =>' % field.name):
                                         with self.block(u'match map.next_key()?'):
-                                            self.emit(u'Some("{}") => Ok({}::{}(map.next_value()?)),'
-                                                      .format(field.name,
-                                                              type_name,
-                                                              variant_name))
-                                            if isinstance(ir.unwrap_aliases(field.data_type)[0],
-                                                          ir.Nullable):
+                                            self.emit(u'Some("%s") => Ok(%s::%s(map.next_value()?)),'
+                                                      % (field.name,
+                                                         type_name,
+                                                         variant_name))
+                                            if kind in _NULLABLE_VARIANTS:
                                                 # if it's null, the field can be omitted entirely
-                                                self.emit(u'None => Ok({}::{}(None)),'
-                                                          .format(type_name, variant_name))
+                                                self.emit(u'None => Ok(%s::%s(None)),'
+                                                          % (type_name, variant_name))
                                             else:
                                                 self.emit(u'None => Err('
-                                                          u'de::Error::missing_field("{}")),'
-                                                          .format(field.name))
+                                                          u'de::Error::missing_field("%s")),'
+                                                          % field.name)
                                             self.emit(u'_ => Err(de::Error::unknown_field('
                                                       u'tag, VARIANTS))')
                             if not union.closed:
                                 with self.block(u'_ =>'):
                                     self.emit(u'crate::eat_json_fields(&mut map)?;')
-                                    self.emit(u'Ok({}::Other)'.format(type_name))
+                                    self.emit(u'Ok(%s::Other)' % type_name)
                             else:
                                 self.emit(u'_ => Err(de::Error::unknown_variant(tag, VARIANTS))')
-            self.generate_multiline_list(
-                    list(u'"{}"'.format(field.name) for field in union.all_fields),
-                    before='const VARIANTS: &[&str] = &',
-                    after=';',
-                    delim=(u'[', u']'),)
-            self.emit(u'deserializer.deserialize_struct("{}", VARIANTS, EnumVisitor)'.format(
-                union.name))
+            self._emit_names_const(u'VARIANTS', [field.name for field in union.all_fields])
+            self.emit(u'deserializer.deserialize_struct("%s", VARIANTS, EnumVisitor)' % union.name)
         self.emit()
         with self._impl_serialize(type_name):
             self.emit(u'// union serializer')
@@ -612,77 +815,73 @@ class RustBackend(RustHelperBackend):
             else:
                 self.emit(u'use serde::ser::SerializeStruct;')
                 with self.block(u'match *self'):
-                    for field in union.all_fields:
-                        if field.catch_all:
-                            # Handle the 'Other' variant at the end.
-                            continue
-                        variant_name = self.enum_variant_name(field)
-                        if isinstance(field.data_type, ir.Void):
-                            with self.block(u'{}::{} =>'.format(type_name, variant_name)):
+                    for field, variant_name, ultimate_type in variants:
+                        kind = field._rust_kind
+                        if kind == _VOID_VARIANT:
+                            with self.block(u'%s::%s =>' % (type_name, variant_name)):
                                 self.emit(u'// unit')
-                                self.emit(u'let mut s = serializer.serialize_struct("{}", 1)?;'
-                                          .format(union.name))
-                                self.emit(u's.serialize_field(".tag", "{}")?;'.format(field.name))
+                                self.emit(u'let mut s = serializer.serialize_struct("%s", 1)?;'
+                                          % union.name)
+                                self.emit(u's.serialize_field(".tag", "%s")?;' % field.name)
                                 self.emit(u's.end()')
                         else:
-                            ultimate_type = ir.unwrap(field.data_type)[0]
                             needs_x = not (isinstance(field.data_type, ir.Struct)
                                            and not field.data_type.all_fields)
                             ref_x = 'ref x' if needs_x else '_'
-                            with self.block(u'{}::{}({}) =>'.format(
+                            with self.block(u'%s::%s(%s) =>' % (
                                     type_name, variant_name, ref_x)):
-                                if self.is_enum_type(ultimate_type):
+                                if kind == _ENUM_VARIANT or kind == _NULLABLE_ENUM_VARIANT:
                                     # Inner type is a union or polymorphic struct; need to always
                                     # emit another nesting level.
                                     self.emit(u'// union or polymporphic struct')
-                                    self.emit(u'let mut s = serializer.serialize_struct("{}", 2)?;'
-                                              .format(union.name))
-                                    self.emit(u's.serialize_field(".tag", "{}")?;'
-                                              .format(field.name))
-                                    self.emit(u's.serialize_field("{}", x)?;'.format(field.name))
+                                    self.emit(u'let mut s = serializer.serialize_struct("%s", 2)?;'
+                                              % union.name)
+                                    self.emit(u's.serialize_field(".tag", "%s")?;'
+                                              % field.name)
+                                    self.emit(u's.serialize_field("%s", x)?;' % field.name)
                                     self.emit(u's.end()')
-                                elif isinstance(ir.unwrap_aliases(field.data_type)[0], ir.Nullable):
+                                elif kind in _NULLABLE_VARIANTS:
                                     self.emit(u'// nullable (struct or primitive)')
                                     # If it's nullable and the value is None, just emit the tag and
                                     # nothing else, otherwise emit the fields directly at the same
                                     # level.
-                                    num_fields = 1 if ir.is_primitive_type(ultimate_type) \
+                                    num_fields = 1 if kind == _NULLABLE_PRIMITIVE_VARIANT \
                                         else len(ultimate_type.all_fields) + 1
-                                    self.emit(u'let n = if x.is_some() {{ {} }} else {{ 1 }};'
-                                              .format(num_fields + 1))
-                                    self.emit(u'let mut s = serializer.serialize_struct("{}", n)?;'
-                                              .format(union.name))
-                                    self.emit(u's.serialize_field(".tag", "{}")?;'
-                                              .format(field.name))
+                                    self.emit(u'let n = if x.is_some() { %s } else { 1 };'
+                                              % (num_fields + 1))
+                                    self.emit(u'let mut s = serializer.serialize_struct("%s", n)?;'
+                                              % union.name)
+                                    self.emit(u's.serialize_field(".tag", "%s")?;'
+                                              % field.name)
                                     with self.block(u'if let Some(ref x) = x'):
-                                        if ir.is_primitive_type(ultimate_type):
-                                            self.emit(u's.serialize_field("{}", &x)?;'
-                                                      .format(field.name))
+                                        if kind == _NULLABLE_PRIMITIVE_VARIANT:
+                                            self.emit(u's.serialize_field("%s", &x)?;'
+                                                      % field.name)
                                         else:
                                             self.emit(u'x.internal_serialize::<S>(&mut s)?;')
                                     self.emit(u's.end()')
-                                elif isinstance(ultimate_type, ir.Struct):
+                                elif kind == _STRUCT_VARIANT:
                                     self.emit(u'// struct')
-                                    self.emit(u'let mut s = serializer.serialize_struct("{}", {})?;'
-                                              .format(union.name,
-                                                      len(ultimate_type.all_fields) + 1))
-                                    self.emit(u's.serialize_field(".tag", "{}")?;'
-                                              .format(field.name))
+                                    self.emit(u'let mut s = serializer.serialize_struct("%s", %s)?;'
+                                              % (union.name,
+                                                 len(ultimate_type.all_fields) + 1))
+                                    self.emit(u's.serialize_field(".tag", "%s")?;'
+                                              % field.name)
                                     if ultimate_type.all_fields:
                                         self.emit(u'x.internal_serialize::<S>(&mut s)?;')
                                     self.emit(u's.end()')
                                 else:
                                     self.emit(u'// primitive')
-                                    self.emit(u'let mut s = serializer.serialize_struct("{}", 2)?;'
-                                              .format(union.name))
-                                    self.emit(u's.serialize_field(".tag", "{}")?;'
-                                              .format(field.name))
-                                    self.emit(u's.serialize_field("{}", x)?;'.format(field.name))
+                                    self.emit(u'let mut s = serializer.serialize_struct("%s", 2)?;'
+                                              % union.name)
+                                    self.emit(u's.serialize_field(".tag", "%s")?;'
+                                              % field.name)
+                                    self.emit(u's.serialize_field("%s", x)?;' % field.name)
                                     self.emit(u's.end()')
                     if not union.closed:
-                        self.emit(u'{}::Other => Err(::serde::ser::Error::custom('
+                        self.emit(u'%s::Other => Err(::serde::ser::Error::custom('
                                   u'"cannot serialize \'Other\' variant"))'
-                                  .format(type_name))
+                                  % type_name)
         self.emit()
 
     # Helpers
@@ -691,10 +890,22 @@ class RustBackend(RustHelperBackend):
         if doc_string is not None:
             for idx, chunk in enumerate(doc_string.split(u'\n\n')):
                 if idx != 0: self.emit(prefix)
-                docf = lambda tag, val: self._docf(tag, val)
-                self.emit_wrapped_text(
-                        self.process_doc(chunk, docf),
-                        prefix=prefix + u' ', width=100)
+                self._emit_wrapped_doc(self.process_doc(chunk, self._docf), prefix + u' ')
+
+    def _emit_wrapped_doc(self, text, prefix):
+        """
+        Emit doc text, word-wrapped to 100 columns. Wrapping is comparatively slow and the same
+        text gets emitted in many places, so the output is cached by text, prefix and indent.
+        The text must have its doc references already resolved, since those depend on the
+        current namespace and type.
+        """
+        key = (text, prefix, self.cur_indent)
+        try:
+            self._buf += self._wrapped_docs[key]
+        except KeyError:
+            start = len(self._buf)
+            self.emit_wrapped_text(text, prefix=prefix, width=100)
+            self._wrapped_docs[key] = bytes(self._buf[start:])
 
     def _docf(self, tag, val):
         if tag == 'route':
@@ -711,7 +922,7 @@ class RustBackend(RustHelperBackend):
             else:
                 target = self.route_name_raw(val, version)
                 label = target
-            return '[`{}()`]({})'.format(label, target)
+            return '[`%s()`](%s)' % (label, target)
         elif tag == 'field':
             if '.' in val:
                 cls_name, field = val.rsplit('.', 1)
@@ -729,107 +940,111 @@ class RustBackend(RustHelperBackend):
                         # Hopefully we're documenting one of the variants right now, or else this
                         # is going to look weird.
                         field = self.field_name_raw(field)
-                        return '`{}`'.format(field)
+                        return '`%s`' % field
                     field = self.enum_variant_name_raw(field)
-                    return '[`{}::{}`]({}::{})'.format(type_name, field, type_name, field)
+                    return '[`%s::%s`](%s::%s)' % (type_name, field, type_name, field)
                 else:
                     field = self.field_name_raw(field)
                     # we can't link to the field itself, so just link to the struct
-                    return '[`{}::{}`]({})'.format(type_name, field, type_name)
+                    return '[`%s::%s`](%s)' % (type_name, field, type_name)
             else:
                 # link is relative to the current type
                 type_name = self._rust_type(self._current_type)
                 if self.is_enum_type(self._current_type):
                     variant_name = self.enum_variant_name_raw(val)
-                    return '[`{}`]({}::{})'.format(
+                    return '[`%s`](%s::%s)' % (
                         variant_name, type_name, variant_name)
                 else:
                     field_name = self.field_name_raw(val)
                     # we could, but don't bother linking to the struct because we're already there.
                     # return '[`{}`]({})'.format(field_name, current_rust_type)
-                    return '`{}`'.format(field_name)
+                    return '`%s`' % field_name
         elif tag == 'type':
             if '.' in val:
                 ns, typ_name = val.split('.')
                 typ = self._all_types[ns][typ_name]
                 rust_name = self._rust_type(typ, no_qualify=True)
                 full_rust_name = self._rust_type(typ)
-                return '[`{}::{}`]({})'.format(
+                return '[`%s::%s`](%s)' % (
                     ns, rust_name, full_rust_name)
             else:
                 typ = self._all_types[self._current_namespace][val]
                 rust_name = self._rust_type(typ)
-                return '[`{}`]({})'.format(rust_name, rust_name)
+                return '[`%s`](%s)' % (rust_name, rust_name)
         elif tag == 'link':
             title, url = val.rsplit(' ', 1)
-            return '[{}]({})'.format(title, url)
+            return '[%s](%s)' % (title, url)
         elif tag == 'val':
             if val == 'null':
                 return '`None`'
             else:
-                return '`{}`'.format(val)
+                return '`%s`' % val
         else:
-            print("WARNING: unrecognized link tag '{}'".format(tag))
-            return '`{}`'.format(val)
+            print("WARNING: unrecognized link tag '%s'" % tag)
+            return '`%s`' % val
+
+    def _emit_names_const(self, const_name, names):
+        """
+        Emit a `const` array of string literals, one per line, aligned after the opening bracket.
+        """
+        before = u'const %s: &[&str] = &[' % const_name
+        self._emit_chunk(
+            before
+            + (u',\n' + u' ' * len(before)).join(u'"%s"' % name for name in names)
+            + u'];')
 
-    @contextmanager
     def _impl_deserialize(self, type_name):
-        with self.block(u'impl<\'de> ::serde::de::Deserialize<\'de> for {}'.format(type_name)), \
-                self.emit_rust_function_def(
-                    u'deserialize<D: ::serde::de::Deserializer<\'de>>',
-                    [u'deserializer: D'],
-                    u'Result<Self, D::Error>'):
-            yield
+        return _NestedBlocks(
+            self.block(u'impl<\'de> ::serde::de::Deserialize<\'de> for %s' % type_name),
+            self.emit_rust_function_def(
+                u'deserialize<D: ::serde::de::Deserializer<\'de>>',
+                [u'deserializer: D'],
+                u'Result<Self, D::Error>'))
 
-    @contextmanager
     def _impl_serialize(self, type_name):
-        with self.block(u'impl ::serde::ser::Serialize for {}'.format(type_name)), \
-                self.emit_rust_function_def(
-                    u'serialize<S: ::serde::ser::Serializer>',
-                    [u'&self', u'serializer: S'],
-                    u'Result<S::Ok, S::Error>'):
-            yield
-
-    def _impl_default_for_struct(self, struct):
+        return _NestedBlocks(
+            self.block(u'impl ::serde::ser::Serialize for %s' % type_name),
+            self.emit_rust_function_def(
+                u'serialize<S: ::serde::ser::Serializer>',
+                [u'&self', u'serializer: S'],
+                u'Result<S::Ok, S::Error>'))
+
+    def _impl_default_for_struct(self, struct, fields):
         struct_name = self.struct_name(struct)
-        with self.block(u'impl Default for {}'.format(struct_name)):
+        with self.block(u'impl Default for %s' % struct_name):
             with self.emit_rust_function_def(u'default', [], u'Self'):
                 with self.block(struct_name):
-                    for field in struct.all_fields:
-                        self.emit(u'{}: {},'.format(
-                            self.field_name(field), self._default_value(field)))
+                    for field, field_name in fields:
+                        self.emit(u'%s: %s,' % (field_name, self._default_value(field)))
 
     def _impl_struct(self, struct):
-        return self.block(u'impl {}'.format(self.struct_name(struct)))
+        return self.block(u'impl %s' % self.struct_name(struct))
 
-    def _emit_new_for_struct(self, struct):
+    def _emit_new_for_struct(self, struct, required_fields, optional_fields):
         struct_name = self.struct_name(struct)
         first = True
 
-        if struct.all_required_fields:
+        if required_fields:
             with self.emit_rust_function_def(
                     u'new',
-                    [u'{}: {}'.format(self.field_name(field), self._rust_type(field.data_type))
-                        for field in struct.all_required_fields],
+                    [u'%s: %s' % (field_name, self._field_type_str(field))
+                        for field, field_name in required_fields],
                     u'Self',
                     access=u'pub'):
                 with self.block(struct_name):
-                    for field in struct.all_required_fields:
+                    for _, field_name in required_fields:
                         # shorthand assignment
-                        self.emit(u'{},'.format(self.field_name(field)))
-                    for field in struct.all_optional_fields:
-                        self.emit(u'{}: {},'.format(
-                            self.field_name(field),
-                            self._default_value(field)))
+                        self.emit(u'%s,' % field_name)
+                    for field, field_name in optional_fields:
+                        self.emit(u'%s: %s,' % (field_name, self._default_value(field)))
             first = False
 
-        for field in struct.all_optional_fields:
+        for field, field_name in optional_fields:
             if first:
                 first = False
             else:
                 self.emit()
 
-            field_name = self.field_name(field)
             if isinstance(field.data_type, ir.Nullable):
                 # If it's a nullable type, the default is always None. Change the argument type to
                 # the inner type, because if the user is using builder methods it means they don't
@@ -841,11 +1056,11 @@ class RustBackend(RustHelperBackend):
                 value = u'value'
 
             with self.emit_rust_function_def(
-                    u'with_{}'.format(field_name),
-                    [u'mut self', u'value: {}'.format(self._rust_type(field_type))],
+                    u'with_%s' % field_name,
+                    [u'mut self', u'value: %s' % self._rust_type(field_type)],
                     u'Self',
                     access=u'pub'):
-                self.emit(u'self.{} = {};'.format(field_name, value))
+                self.emit(u'self.%s = %s;' % (field_name, value))
                 self.emit(u'self')
 
     def _default_value(self, field):
@@ -859,9 +1074,9 @@ class RustBackend(RustHelperBackend):
                 if variant.name == field.default.tag_name:
                     default_variant = variant
             if default_variant is None:
-                raise RuntimeError('ERROR: didn\'t find matching variant of {}: {}'
-                                   .format(field.data_type.name, field.default.tag_name))
-            return u'{}::{}'.format(
+                raise RuntimeError('ERROR: didn\'t find matching variant of %s: %s'
+                                   % (field.data_type.name, field.default.tag_name))
+            return u'%s::%s' % (
                 self._rust_type(field.default.union_data_type),
                 self.enum_variant_name(default_variant))
         elif isinstance(field.data_type, ir.Boolean):
@@ -873,12 +1088,12 @@ class RustBackend(RustHelperBackend):
             if not field.default:
                 return u'String::new()'
             else:
-                return u'"{}".to_owned()'.format(field.default)
+                return u'"%s".to_owned()' % field.default
         else:
-            print(u'WARNING: unhandled default value {}'.format(field.default))
-            print(u'    in field: {}'.format(field))
+            print(u'WARNING: unhandled default value %s' % field.default)
+            print(u'    in field: %s' % field)
             if isinstance(field.data_type, ir.Alias):
-                print(u'    unwrapped alias: {}'.format(ir.unwrap_aliases(field.data_type)[0]))
+                print(u'    unwrapped alias: %s' % ir.unwrap_aliases(field.data_type)[0])
             return field.default
 
     def _needs_explicit_default(self, field):
@@ -887,11 +1102,11 @@ class RustBackend(RustHelperBackend):
                          or (isinstance(field.data_type, ir.Boolean) and not field.default))
 
     def _impl_error(self, type_name):
-        with self.block(u'impl ::std::error::Error for {}'.format(type_name)):
+        with self.block(u'impl ::std::error::Error for %s' % type_name):
             with self.emit_rust_function_def(u'description', [u'&self'], u'&str'):
-                self.emit(u'"{}"'.format(type_name))
+                self.emit(u'"%s"' % type_name)
         self.emit()
-        with self.block(u'impl ::std::fmt::Display for {}'.format(type_name)):
+        with self.block(u'impl ::std::fmt::Display for %s' % type_name):
             with self.emit_rust_function_def(
                     u'fmt',
                     [u'&self', u'f: &mut ::std::fmt::Formatter<\'_>'],
@@ -902,56 +1117,66 @@ class RustBackend(RustHelperBackend):
     # Naming Rules
 
     def _rust_type(self, typ, no_qualify=False):
-        if isinstance(typ, ir.Nullable):
-            return u'Option<{}>'.format(self._rust_type(typ.data_type, no_qualify))
-        elif isinstance(typ, ir.Void):
-            return u'()'
-        elif isinstance(typ, ir.Bytes):
-            return u'Vec<u8>'
-        elif isinstance(typ, ir.Int32):
-            return u'i32'
-        elif isinstance(typ, ir.UInt32):
-            return u'u32'
-        elif isinstance(typ, ir.Int64):
-            return u'i64'
-        elif isinstance(typ, ir.UInt64):
-            return u'u64'
-        elif isinstance(typ, ir.Float32):
-            return u'f32'
-        elif isinstance(typ, ir.Float64):
-            return u'f64'
-        elif isinstance(typ, ir.Boolean):
-            return u'bool'
-        elif isinstance(typ, ir.String):
-            return u'String'
-        elif isinstance(typ, ir.Timestamp):
-            return u'String /*Timestamp*/'  # TODO
-        elif isinstance(typ, ir.List):
-            return u'Vec<{}>'.format(self._rust_type(typ.data_type, no_qualify))
-        elif isinstance(typ, ir.Map):
-            return u'::std::collections::HashMap<{}, {}>'.format(
-                self._rust_type(typ.key_data_type, no_qualify),
-                self._rust_type(typ.value_data_type, no_qualify))
-        elif isinstance(typ, ir.Alias):
-            if typ.namespace.name == self._current_namespace or no_qualify:
-                return self.alias_name(typ)
-            else:
-                return u'super::{}::{}'.format(
-                    self.namespace_name(typ.namespace),
-                    self.alias_name(typ))
-        elif isinstance(typ, ir.UserDefined):
-            if isinstance(typ, ir.Struct):
-                name = self.struct_name(typ)
-            elif isinstance(typ, ir.Union):
-                name = self.enum_name(typ)
-            else:
-                raise RuntimeError(u'ERROR: user-defined type "{}" is neither Struct nor Union???'
-                                   .format(typ))
-            if typ.namespace.name == self._current_namespace or no_qualify:
-                return name
-            else:
-                return u'super::{}::{}'.format(
-                    self.namespace_name(typ.namespace),
-                    name)
+        key = (id(typ), no_qualify)
+        try:
+            return self._rust_types[key]
+        except KeyError:
+            pass
+        rust_type = self._rust_type_uncached(typ, no_qualify)
+        self._rust_types[key] = rust_type
+        return rust_type
+
+    def _field_type_str(self, field):
+        """
+        The Rust type of a field's (or an alias's) data type, cached on the field as
+        _rust_type_str. Like _rust_type(), it depends on the current namespace, and inherited
+        fields are shared between namespaces, so the namespace is cached along with it.
+        """
+        try:
+            namespace, type_str = field._rust_type_str
+            if namespace == self._current_namespace:
+                return type_str
+        except AttributeError:
+            pass
+        type_str = self._rust_type(field.data_type)
+        field._rust_type_str = (self._current_namespace, type_str)
+        return type_str
+
+    def _rust_type_uncached(self, typ, no_qualify):
+        try:
+            return _RUST_PRIMITIVE_TYPES[type(typ)]
+        except KeyError:
+            pass
+        try:
+            handler = self._rust_type_handlers[type(typ)]
+        except KeyError:
+            raise RuntimeError(u'ERROR: unhandled type "%s"' % typ)
+        return handler(typ, no_qualify)
+
+    def _rust_nullable_type(self, typ, no_qualify):
+        return u'Option<%s>' % self._rust_type(typ.data_type, no_qualify)
+
+    def _rust_list_type(self, typ, no_qualify):
+        return u'Vec<%s>' % self._rust_type(typ.data_type, no_qualify)
+
+    def _rust_map_type(self, typ, no_qualify):
+        return u'::std::collections::HashMap<%s, %s>' % (
+            self._rust_type(typ.key_data_type, no_qualify),
+            self._rust_type(typ.value_data_type, no_qualify))
+
+    def _rust_alias_type(self, typ, no_qualify):
+        return self._qualified_name(typ, self.alias_name(typ), no_qualify)
+
+    def _rust_struct_type(self, typ, no_qualify):
+        return self._qualified_name(typ, self.struct_name(typ), no_qualify)
+
+    def _rust_union_type(self, typ, no_qualify):
+        return self._qualified_name(typ, self.enum_name(typ), no_qualify)
+
+    def _qualified_name(self, typ, name, no_qualify):
+        if typ.namespace.name == self._current_namespace or no_qualify:
+            return name
         else:
-            raise RuntimeError(u'ERROR: unhandled type "{}"'.format(typ))
+            return u'super::%s::%s' % (
+                self.namespace_name(typ.namespace),
+                name)